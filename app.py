@@ -1,95 +1,167 @@
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from lmfit import Model
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy.optimize import curve_fit
 
-def run_kinetic_fitting(file_path, output_dir):
-    figures_dir = os.path.join(output_dir, 'Figures_Kinetics')
-    os.makedirs(figures_dir, exist_ok=True)  # Create directory for figures if it doesn't exist
+from utils import map_sheets, open_workbook, save_png
+
+# Compile the model kernels with numba when available; otherwise they run as plain NumPy
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+@njit('float64[:](float64[:], float64, float64)', cache=True, fastmath=True)
+def _pseudo_first_order(t, q_e, k1):
+    return q_e * (1 - np.exp(-k1 * t))
+
+@njit('float64[:](float64[:], float64, float64)', cache=True, fastmath=True)
+def _pseudo_second_order(t, q_e, k2):
+    return (q_e**2 * k2 * t) / (1 + q_e * k2 * t)
+
+# Evaluation budget for curve_fit; matches lmfit's default of 2000*(nvars+1) so slow
+# or near-linear uptake curves still converge
+CURVE_FIT_MAXFEV = 6000
+
+# Analytic partial derivatives of each model, one row per data point and one column per parameter
+@njit('float64[:, :](float64[:], float64, float64)', cache=True, fastmath=True)
+def _pseudo_first_order_jac(t, q_e, k1):
+    decay = np.exp(-k1 * t)
+    jac = np.empty((t.size, 2))
+    jac[:, 0] = 1 - decay
+    jac[:, 1] = q_e * t * decay
+    return jac
+
+@njit('float64[:, :](float64[:], float64, float64)', cache=True, fastmath=True)
+def _pseudo_second_order_jac(t, q_e, k2):
+    u = q_e * k2 * t
+    denom = (1 + u)**2
+    jac = np.empty((t.size, 2))
+    jac[:, 0] = u * (2 + u) / denom
+    jac[:, 1] = q_e**2 * t / denom
+    return jac
+
+# Define pseudo-first-order and pseudo-second-order models
+# (thin wrappers so the kernels always get float64 input)
+def pseudo_first_order(t, q_e, k1):
+    return _pseudo_first_order(np.asarray(t, dtype=np.float64), float(q_e), float(k1))
+
+def pseudo_second_order(t, q_e, k2):
+    return _pseudo_second_order(np.asarray(t, dtype=np.float64), float(q_e), float(k2))
+
+# Jacobians with the same signatures, passed to curve_fit as jac
+def pseudo_first_order_jac(t, q_e, k1):
+    return _pseudo_first_order_jac(np.asarray(t, dtype=np.float64), float(q_e), float(k1))
+
+def pseudo_second_order_jac(t, q_e, k2):
+    return _pseudo_second_order_jac(np.asarray(t, dtype=np.float64), float(q_e), float(k2))
+
+def fit_sheet(sheet, t_data, q_data, figures_dir):
+    """Fit both kinetic models to one sheet and save its figure.
+
+    Runs in a worker process; returns the result rows, the figure path and
+    the PNG bytes (both None if a fit failed).
+    """
     results_list = []
+
+    q_var = q_data.var()  # Shared denominator of both R^2 values
+
+    # Create a new figure only once per sheet
+    fig = Figure(figsize=(8, 6))  # Set figure size for consistency
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(t_data, q_data, 'bo', label="Data")
+
+    try:
+        # Fit and plot pseudo-first-order model
+        (q_e_1st, k1), _ = curve_fit(pseudo_first_order, t_data, q_data, p0=[np.max(q_data), 0.1],
+                                     jac=pseudo_first_order_jac, maxfev=CURVE_FIT_MAXFEV)
+        first_order_fit = pseudo_first_order(t_data, q_e_1st, k1)
+        ax.plot(t_data, first_order_fit, 'r-', label=f"1st Order Fit: q_e={q_e_1st:.2f}, k1={k1:.2f}")
+        r_squared_1st = 1 - (q_data - first_order_fit).var() / q_var
+        results_list.append({
+            'Sheet': sheet, 
+            'Model': 'Pseudo First Order', 
+            'q_e': q_e_1st, 
+            'k': k1, 
+            'R^2': r_squared_1st
+        })
     
-    # Define pseudo-first-order and pseudo-second-order models
-    def pseudo_first_order(t, q_e, k1):
-        return q_e * (1 - np.exp(-k1 * t))
+        # Fit and plot pseudo-second-order model
+        (q_e_2nd, k2), _ = curve_fit(pseudo_second_order, t_data, q_data, p0=[np.max(q_data), 0.001],
+                                     jac=pseudo_second_order_jac, maxfev=CURVE_FIT_MAXFEV)
+        second_order_fit = pseudo_second_order(t_data, q_e_2nd, k2)
+        ax.plot(t_data, second_order_fit, 'g--', label=f"2nd Order Fit: q_e={q_e_2nd:.2f}, k2={k2:.2f}")
+        r_squared_2nd = 1 - (q_data - second_order_fit).var() / q_var
+        results_list.append({
+            'Sheet': sheet, 
+            'Model': 'Pseudo Second Order', 
+            'q_e': q_e_2nd, 
+            'k': k2, 
+            'R^2': r_squared_2nd
+        })
+
+    except Exception as e:
+        print(f"Error fitting model for sheet '{sheet}': {e}")
+        return results_list, None, None
 
-    def pseudo_second_order(t, q_e, k2):
-        return (q_e**2 * k2 * t) / (1 + q_e * k2 * t)
+    # Customize and save each plot as one figure per sheet
+    ax.set_xlabel('Time (min)')
+    ax.set_ylabel('Adsorption Amount (qt)')
+    ax.legend()
+    ax.set_title(f'Kinetic Model Fits for {sheet}')
 
-    # Load the Excel file and get sheet names
-    excel_data = pd.ExcelFile(file_path)
-    sheet_names = excel_data.sheet_names
+    # Save the figure as a PNG file
+    fig_path = os.path.join(figures_dir, f'Kinetic_Fit_{sheet}.png')
+    fig_bytes = save_png(canvas, fig_path)
+
+    return results_list, fig_path, fig_bytes
+
+def run_kinetic_fitting(file_path, output_dir):
+    figures_dir = os.path.join(output_dir, 'Figures_Kinetics')
+    os.makedirs(figures_dir, exist_ok=True)  # Create directory for figures if it doesn't exist
+    results_list = []
 
     # List to store the paths of the figures for display in Streamlit
     figure_paths = []
+    figure_images = []  # Matching PNG bytes, so the frontend doesn't re-read the files
 
-    for sheet in sheet_names:
-        # Read data from the first two columns, skip the first row
-        data = pd.read_excel(file_path, sheet_name=sheet, skiprows=1, usecols=[0, 1])
-        data.columns = ['time(min)', 'qt(mg/g)']
-        
-        # Ensure required columns are present
-        t_data = data['time(min)'].dropna().values
-        q_data = data['qt(mg/g)'].dropna().values
-        
-        # Model setup with lmfit for enhanced control
-        first_order_model = Model(pseudo_first_order)
-        first_order_params = first_order_model.make_params(q_e=np.max(q_data), k1=0.1)
+    # Open the workbook once and parse every sheet from the same handle
+    jobs = []
+    with open_workbook(file_path) as excel_data:
+        for sheet in excel_data.sheet_names:
+            # Read data from the first two columns, skip the first row
+            data = excel_data.parse(sheet, skiprows=1, usecols=[0, 1])
+            data.columns = ['time(min)', 'qt(mg/g)']
         
-        second_order_model = Model(pseudo_second_order)
-        second_order_params = second_order_model.make_params(q_e=np.max(q_data), k2=0.001)
-        
-        # Create a new figure only once per sheet
-        fig, ax = plt.subplots(figsize=(8, 6))  # Set figure size for consistency
-        ax.plot(t_data, q_data, 'bo', label="Data")
-
-        try:
-            # Fit and plot pseudo-first-order model
-            first_order_result = first_order_model.fit(q_data, t=t_data, params=first_order_params)
-            ax.plot(t_data, first_order_result.best_fit, 'r-', label=f"1st Order Fit: q_e={first_order_result.params['q_e'].value:.2f}, k1={first_order_result.params['k1'].value:.2f}")
-            r_squared_1st = 1 - first_order_result.residual.var() / np.var(q_data)
-            results_list.append({
-                'Sheet': sheet, 
-                'Model': 'Pseudo First Order', 
-                'q_e': first_order_result.params['q_e'].value, 
-                'k': first_order_result.params['k1'].value, 
-                'R^2': r_squared_1st
-            })
-            
-            # Fit and plot pseudo-second-order model
-            second_order_result = second_order_model.fit(q_data, t=t_data, params=second_order_params)
-            ax.plot(t_data, second_order_result.best_fit, 'g--', label=f"2nd Order Fit: q_e={second_order_result.params['q_e'].value:.2f}, k2={second_order_result.params['k2'].value:.2f}")
-            r_squared_2nd = 1 - second_order_result.residual.var() / np.var(q_data)
-            results_list.append({
-                'Sheet': sheet, 
-                'Model': 'Pseudo Second Order', 
-                'q_e': second_order_result.params['q_e'].value, 
-                'k': second_order_result.params['k2'].value, 
-                'R^2': r_squared_2nd
-            })
-
-        except Exception as e:
-            print(f"Error fitting model for sheet '{sheet}': {e}")
-            continue
-
-        # Customize and save each plot as one figure per sheet
-        ax.set_xlabel('Time (min)')
-        ax.set_ylabel('Adsorption Amount (qt)')
-        ax.legend()
-        ax.set_title(f'Kinetic Model Fits for {sheet}')
-        
-        # Save the figure as a PNG file
-        fig_path = os.path.join(figures_dir, f'Kinetic_Fit_{sheet}.png')
-        fig.savefig(fig_path)
-        plt.close(fig)  # Close the figure after saving to avoid duplicates
+            # Keep only the rows where both time and qt are finite numbers
+            try:
+                t_all = data['time(min)'].to_numpy(dtype=np.float64)
+                q_all = data['qt(mg/g)'].to_numpy(dtype=np.float64)
+            except ValueError:
+                print(f"Non-numeric data in sheet '{sheet}'. Skipping...")
+                continue
+            valid = np.isfinite(t_all) & np.isfinite(q_all)
+            t_data = t_all[valid]
+            q_data = q_all[valid]
+            jobs.append((sheet, t_data, q_data, figures_dir))
+
+    outcomes = map_sheets(fit_sheet, jobs)
 
+    for sheet_results, fig_path, fig_bytes in outcomes:
+        results_list.extend(sheet_results)
         # Append the path of the individual figure to the list
-        figure_paths.append(fig_path)
+        if fig_path is not None:
+            figure_paths.append(fig_path)
+            figure_images.append(fig_bytes)
 
     # Convert results to DataFrame
     summary_df = pd.DataFrame(results_list)
     if summary_df.empty:
         print("No valid results were generated.")
-        return None, figure_paths  # Return figure paths if no results
+        return None, figure_paths, figure_images  # Return figures if no results
 
-    return summary_df, figure_paths  # Return summary DataFrame and the list of figure paths
+    return summary_df, figure_paths, figure_images  # Return summary DataFrame and the figures
@@ -1,7 +1,12 @@
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.collections import LineCollection
+from matplotlib.lines import Line2D
+
+from utils import map_sheets, open_workbook, save_png
 
 # Define predefined peaks for FTIR analysis (simplified version)
 peaks = [
@@ -14,95 +19,142 @@ peaks = [
     {'wavenumber': 1100, 'label': 'C-O Stretch (Ether)'},
     {'wavenumber': 1650, 'label': 'C=N Stretch (Imine)'}
 ]
-
-def run_ftir_analysis(file_path, output_dir):
+peak_wavenumbers = np.array([peak['wavenumber'] for peak in peaks], dtype=np.float64)
+
+def closest_indices(axis, targets):
+    """Return the index of the value in ascending ``axis`` closest to each target, ignoring NaNs.
+
+    Ties resolve like an argmin over the descending spectrum: the larger value wins, and
+    of repeated values the last one (first in descending order) is used.
+
+    >>> closest_indices(np.array([1.0, 2.0, 2.0, 4.0, np.nan]), np.array([2.0, 3.0, 0.0, 9.0]))
+    array([2, 3, 0, 3])
+    """
+    valid = np.flatnonzero(~np.isnan(axis))
+    values = axis[valid]
+    idx = np.clip(np.searchsorted(values, targets), 1, len(values) - 1)
+    # Step back to the left neighbour when it is strictly closer (ties keep the larger value)
+    idx -= (targets - values[idx - 1]) < (values[idx] - targets)
+    # Move to the last copy of the matched value
+    idx = np.searchsorted(values, values[idx], side='right') - 1
+    return valid[idx]
+
+def analyze_sheet(sheet, wavenumber, transmittance, color, figures_dir, peak_data_dir, dpi):
+    """Plot one FTIR spectrum and save its reference-peak details.
+
+    Runs in a worker process; returns the sorted spectrum as float32 (for the
+    composite plot), the figure path and PNG bytes, and the summary rows for this sheet.
+    """
+    # Sort wavenumber in decreasing order (from left to right on the plot)
+    sorted_indices = np.argsort(wavenumber)[::-1]  # Sort in descending order
+    wavenumber = wavenumber[sorted_indices]
+    transmittance = transmittance[sorted_indices]
+    # Single precision is plenty for drawing; the peak lookup and CSVs keep float64
+    wavenumber_plot = wavenumber.astype(np.float32)
+    transmittance_plot = transmittance.astype(np.float32)
+
+    # Save individual figure for each sheet
+    fig = Figure(figsize=(12, 8), dpi=dpi)  # Drawn at the output resolution, so file and preview match
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    ax.plot(wavenumber_plot, transmittance_plot, label=sheet, color=color)
+
+    # Adjust the x-axis range or invert it
+    ax.set_xlabel("Wavenumber (cm-1)", fontsize=14)
+    ax.set_ylabel("Transmittance (a.u.)", fontsize=14)
+    ax.set_title(f"FTIR Spectrum for {sheet}", fontsize=16)
+
+    # Set x-axis limits to show decreasing wavenumber from right to left
+    ax.set_xlim(3800, 500)  # Wavenumber from right to left in decreasing order
+
+    ax.legend()
+
+    # Save individual figure
+    fig_path = os.path.join(figures_dir, f'FTIR_Spectrum_{sheet}.png')
+    fig_bytes = save_png(canvas, fig_path)
+
+    # Detect peaks in specified wavenumbers and save them for each sample
+    wavenumber_asc = wavenumber[::-1]  # Ascending view for searchsorted
+    transmittance_asc = transmittance[::-1]
+    closest_idx = closest_indices(wavenumber_asc, peak_wavenumbers)
+    peak_data = {'Wavenumber': wavenumber_asc[closest_idx], 'Transmittance': transmittance_asc[closest_idx]}
+
+    # Save peak details for the current sheet
+    peak_df = pd.DataFrame(peak_data)
+    peak_file_path = os.path.join(peak_data_dir, f'Peak_Details_{sheet}.csv')
+    peak_df.to_csv(peak_file_path, index=False)
+
+    # Collect peak details for summary_results straight from the arrays
+    sheet_results = [
+        {'Sample': sheet, 'Wavenumber': peak_wn, 'Transmittance': peak_tr}
+        for peak_wn, peak_tr in zip(peak_data['Wavenumber'].tolist(), peak_data['Transmittance'].tolist())
+    ]
+
+    return wavenumber_plot, transmittance_plot, fig_path, fig_bytes, sheet_results
+
+def run_ftir_analysis(file_path, output_dir, dpi=150):
+    # dpi: resolution of the saved PNGs (150 is plenty for on-screen previews, use 300 for print)
     # Create directories for saving peak details and figures
     peak_data_dir = os.path.join(output_dir, 'Peak_Details_ftir')
     figures_dir = os.path.join(output_dir, 'Figures_FTIR')
     os.makedirs(peak_data_dir, exist_ok=True)
     os.makedirs(figures_dir, exist_ok=True)
 
-    # Load Excel file and get all sheet names
-    excel_data = pd.ExcelFile(file_path)
-    sheet_names = excel_data.sheet_names
-
     summary_results = []
-    composite_fig, composite_ax = plt.subplots(figsize=(12, 8))  # Composite figure for overlay
 
     # List to store the paths of the figures for display in Streamlit
     figure_paths = []
+    figure_images = []  # Matching PNG bytes, so the frontend doesn't re-read the files
 
     # List of colors to use for each individual plot (ensure enough colors for sheets)
     colors = ['blue', 'green', 'red', 'purple', 'orange', 'brown', 'pink', 'cyan', 'magenta', 'yellow']
 
-    # Loop through each sheet to analyze
-    for i, sheet in enumerate(sheet_names):
-        # Read only the first two columns, skipping the first row
-        try:
-            data = pd.read_excel(file_path, sheet_name=sheet, usecols=[0, 1], skiprows=1)
-            data.columns = ['Wavenumber(cm-1)', 'Transmittance(%)']  # Rename columns to expected names
-        except ValueError:
-            print(f"Error reading columns in sheet '{sheet}'. Skipping...")
-            continue
-
-        # Check required columns
-        if 'Wavenumber(cm-1)' not in data.columns or 'Transmittance(%)' not in data.columns:
-            print(f"Missing required columns in sheet '{sheet}'. Skipping...")
-            continue
-
-        wavenumber = data['Wavenumber(cm-1)']
-        transmittance = data['Transmittance(%)'] 
-
-        # Sort wavenumber in decreasing order (from left to right on the plot)
-        sorted_indices = np.argsort(wavenumber)[::-1]  # Sort in descending order
-        wavenumber = wavenumber.iloc[sorted_indices]
-        transmittance = transmittance.iloc[sorted_indices]
-
-        # Offset each curve for clarity and add to composite plot
-        color = colors[i % len(colors)]  # Ensure the same color for both individual and composite plot
-        composite_ax.plot(wavenumber, transmittance - i * 20, label=sheet, color=color)  # Matching colors
-
-        # Save individual figure for each sheet
-        fig, ax = plt.subplots(figsize=(12, 8))
-        ax.plot(wavenumber, transmittance, label=sheet, color=color)
-
-        # Adjust the x-axis range or invert it
-        ax.set_xlabel("Wavenumber (cm-1)", fontsize=14)
-        ax.set_ylabel("Transmittance (a.u.)", fontsize=14)
-        ax.set_title(f"FTIR Spectrum for {sheet}", fontsize=16)
-
-        # Set x-axis limits to show decreasing wavenumber from right to left
-        ax.set_xlim(3800, 500)  # Wavenumber from right to left in decreasing order
-
-        ax.legend()
-
-        # Save individual figure
-        fig_path = os.path.join(figures_dir, f'FTIR_Spectrum_{sheet}.png')
-        fig.savefig(fig_path, dpi=300)
-        plt.close(fig)
+    # Open the workbook once and read each sheet to analyze
+    composite_entries = []  # (position, sheet, color) for each curve of the composite plot
+    jobs = []
+    with open_workbook(file_path) as excel_data:
+        for i, sheet in enumerate(excel_data.sheet_names):
+            # Read only the first two columns, skipping the first row
+            try:
+                data = excel_data.parse(sheet, usecols=[0, 1], skiprows=1)
+                data.columns = ['Wavenumber(cm-1)', 'Transmittance(%)']  # Rename columns to expected names
+            except ValueError:
+                print(f"Error reading columns in sheet '{sheet}'. Skipping...")
+                continue
+
+            # Check required columns
+            if 'Wavenumber(cm-1)' not in data.columns or 'Transmittance(%)' not in data.columns:
+                print(f"Missing required columns in sheet '{sheet}'. Skipping...")
+                continue
+
+            # Work on plain float64 arrays from here on
+            wavenumber = data['Wavenumber(cm-1)'].to_numpy(dtype=np.float64)
+            transmittance = data['Transmittance(%)'].to_numpy(dtype=np.float64)
+
+            color = colors[i % len(colors)]  # Ensure the same color for both individual and composite plot
+            composite_entries.append((i, sheet, color))
+            jobs.append((sheet, wavenumber, transmittance, color, figures_dir, peak_data_dir, dpi))
+
+    outcomes = map_sheets(analyze_sheet, jobs)
+
+    # Offset each curve for clarity; all curves go into the composite plot as one collection
+    segments = []
+    segment_colors = []
+    legend_handles = []
+    for (i, sheet, color), (wavenumber, transmittance, fig_path, fig_bytes, sheet_results) in zip(composite_entries, outcomes):
+        segments.append(np.column_stack([wavenumber, transmittance - i * 20]))
+        segment_colors.append(color)  # Matching colors
+        legend_handles.append(Line2D([], [], color=color, label=sheet))
 
         # Append the path of the individual figure to the list
         figure_paths.append(fig_path)
+        figure_images.append(fig_bytes)
+        summary_results.extend(sheet_results)
 
-        # Detect peaks in specified wavenumbers and save them for each sample
-        peak_data = {'Wavenumber': [], 'Transmittance': []}
-        for peak in peaks:
-            closest_idx = (np.abs(wavenumber - peak['wavenumber'])).argmin()
-            peak_data['Wavenumber'].append(wavenumber.iloc[closest_idx])
-            peak_data['Transmittance'].append(transmittance.iloc[closest_idx])
-
-        # Save peak details for the current sheet
-        peak_df = pd.DataFrame(peak_data)
-        peak_file_path = os.path.join(peak_data_dir, f'Peak_Details_{sheet}.csv')
-        peak_df.to_csv(peak_file_path, index=False)
-
-        # Append peak details to summary_results
-        for _, row in peak_df.iterrows():
-            summary_results.append({
-                'Sample': sheet,
-                'Wavenumber': row['Wavenumber'],
-                'Transmittance': row['Transmittance']
-            })
+    composite_fig = Figure(figsize=(12, 8), dpi=dpi)  # Composite figure for overlay
+    composite_canvas = FigureCanvasAgg(composite_fig)
+    composite_ax = composite_fig.add_subplot(111)
+    composite_ax.add_collection(LineCollection(segments, colors=segment_colors))
 
     # Customize and save the composite plot showing all sheets
     composite_ax.set_xlabel("Wavenumber (cm-1)", fontsize=14)
@@ -115,19 +167,20 @@ def run_ftir_analysis(file_path, output_dir):
     composite_ax.get_yaxis().set_ticks([])
 
     # Display the legend with sample names
-    composite_ax.legend(loc='upper right', fontsize=12)
+    composite_ax.legend(handles=legend_handles, loc='upper right', fontsize=12)
 
     # Save the composite figure only once
     composite_fig_path = os.path.join(figures_dir, 'FTIR_Spectrum_All_Samples_with_Offset.png')
-    composite_fig.savefig(composite_fig_path, dpi=300)
-    plt.close(composite_fig)
+    # The overlay is the largest image; favour fast PNG encoding over file size
+    composite_bytes = save_png(composite_canvas, composite_fig_path, pil_kwargs={'optimize': False, 'compress_level': 1})
 
     # Append composite figure path to the list
     figure_paths.append(composite_fig_path)
+    figure_images.append(composite_bytes)
 
     # Create a summary DataFrame for all sheets and peaks
     summary_df = pd.DataFrame(summary_results)
     summary_df = summary_df.sort_values(by=['Sample', 'Transmittance'], ascending=[True, False])  # Sort by Sample and Transmittance
     summary_df.to_csv(os.path.join(peak_data_dir, 'FTIR_Peak_Summary.csv'), index=False)
 
-    return summary_df, figure_paths  # Return summary DataFrame and the list of figure paths
+    return summary_df, figure_paths, figure_images  # Return summary DataFrame and the figures
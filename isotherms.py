@@ -1,10 +1,18 @@
 import os
 import pandas as pd
 import streamlit as st
-from PIL import Image
 
-# Import the isotherm fitting function
-from isotherms import run_isotherm_fitting
+# Import the analysis functions
+from app import run_kinetic_fitting
+from ftir import run_ftir_analysis
+from utils import EXCEL_ENGINE
+
+# Analysis functions by type; each takes (workbook, output_dir) and returns (summary_df, figure_paths, figure_images)
+# (there is no isotherm or XRD analysis in the tree yet)
+analysis_functions = {
+    "Kinetics": run_kinetic_fitting,
+    "FTIR": run_ftir_analysis,
+}
 
 # Streamlit Interface
 st.title("Data Analysis Interface for Kinetics, Isotherm, FTIR, and XRD")
@@ -39,21 +47,25 @@ if uploaded_file:
     if st.button("Run Analysis"):
         summary_df = None  # Initialize placeholder for summary
         figure_paths = []  # List to store figure paths
+        figure_images = []  # PNG bytes matching figure_paths
 
         try:
-            if analysis_type == "Isotherm":
-                summary_df, figure_paths = run_isotherm_fitting(file_path, folder_path)
+            if analysis_type in analysis_functions:
+                # Open the saved workbook once and hand the handle to the analysis
+                with pd.ExcelFile(file_path, engine=EXCEL_ENGINE) as excel_data:
+                    summary_df, figure_paths, figure_images = analysis_functions[analysis_type](excel_data, folder_path)
+            else:
+                st.error(f"{analysis_type} analysis is not available yet.")
 
-            # Display figures (individual and composite)
+            # Display figures (individual and composite) from the in-memory PNGs
             if figure_paths:
-                for fig_path in figure_paths:
-                    image = Image.open(fig_path)
-                    st.image(image, caption=os.path.basename(fig_path), use_column_width=True)
+                for fig_path, fig_bytes in zip(figure_paths, figure_images):
+                    st.image(fig_bytes, caption=os.path.basename(fig_path), use_column_width=True)
 
             # Display fitting results if available
             if summary_df is not None:
                 st.write(summary_df)
-            else:
+            elif analysis_type in analysis_functions:
                 st.error("No results to display.")
 
         except Exception as e:
@@ -1,91 +1,99 @@
 import os
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-from lmfit import Model
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from scipy.optimize import curve_fit
 import streamlit as st
 from io import BytesIO
 
+# Reuse the compiled models from app.py, so Streamlit reruns of this script don't recompile them
+from app import (CURVE_FIT_MAXFEV, pseudo_first_order, pseudo_second_order,
+                 pseudo_first_order_jac, pseudo_second_order_jac)
+from utils import open_workbook
+
 # Streamlit Title
 st.title("Kinetics Data Analysis Interface")
 
-# Define pseudo-first-order and pseudo-second-order models
-def pseudo_first_order(t, q_e, k1):
-    return q_e * (1 - np.exp(-k1 * t))
-
-def pseudo_second_order(t, q_e, k2):
-    return (q_e**2 * k2 * t) / (1 + q_e * k2 * t)
-
 # Kinetics Fitting Function
 def run_kinetic_fitting(uploaded_file):
     results_list = []
     figure_paths = []  # In-memory figure list
     combined_data = []  # To store original data and fitting results
 
-    # Load Excel file
-    excel_data = pd.ExcelFile(uploaded_file)
-    sheet_names = excel_data.sheet_names
+    # Create the figure and its canvas once and clear it for each sheet
+    fig = Figure(figsize=(8, 6))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
 
-    # Loop through each sheet
-    for sheet in sheet_names:
-        data = pd.read_excel(uploaded_file, sheet_name=sheet, skiprows=1, usecols=[0, 1])
-        data.columns = ['time(min)', 'qt(mg/g)']
+    # Open the workbook once and loop through each sheet
+    with open_workbook(uploaded_file) as excel_data:
+        for sheet in excel_data.sheet_names:
+            data = excel_data.parse(sheet, skiprows=1, usecols=[0, 1])
+            data.columns = ['time(min)', 'qt(mg/g)']
         
-        t_data = data['time(min)'].dropna().values
-        q_data = data['qt(mg/g)'].dropna().values
-
-        # Model setup with lmfit
-        first_order_model = Model(pseudo_first_order)
-        first_order_params = first_order_model.make_params(q_e=np.max(q_data), k1=0.1)
-
-        second_order_model = Model(pseudo_second_order)
-        second_order_params = second_order_model.make_params(q_e=np.max(q_data), k2=0.001)
-
-        # Create figure
-        fig, ax = plt.subplots(figsize=(8, 6))
-        ax.plot(t_data, q_data, 'bo', label="Data")
-
-        # Prepare combined data frame
-        combined_df = pd.DataFrame({"time(min)": t_data, "qt(mg/g)": q_data})
-
-        try:
-            # Fit pseudo-first-order
-            first_order_result = first_order_model.fit(q_data, t=t_data, params=first_order_params)
-            ax.plot(t_data, first_order_result.best_fit, 'r-', label=f"1st Order: q_e={first_order_result.params['q_e'].value:.2f}")
-            r_squared_1st = 1 - first_order_result.residual.var() / np.var(q_data)
-            results_list.append({'Sheet': sheet, 'Model': 'Pseudo First Order', 
-                                 'q_e': first_order_result.params['q_e'].value, 'k': first_order_result.params['k1'].value,
-                                 'R^2': r_squared_1st})
-            combined_df["Pseudo 1st Order"] = first_order_result.best_fit
-
-            # Fit pseudo-second-order
-            second_order_result = second_order_model.fit(q_data, t=t_data, params=second_order_params)
-            ax.plot(t_data, second_order_result.best_fit, 'g--', label=f"2nd Order: q_e={second_order_result.params['q_e'].value:.2f}")
-            r_squared_2nd = 1 - second_order_result.residual.var() / np.var(q_data)
-            results_list.append({'Sheet': sheet, 'Model': 'Pseudo Second Order', 
-                                 'q_e': second_order_result.params['q_e'].value, 'k': second_order_result.params['k2'].value,
-                                 'R^2': r_squared_2nd})
-            combined_df["Pseudo 2nd Order"] = second_order_result.best_fit
-
-        except Exception as e:
-            st.error(f"Error fitting model for sheet '{sheet}': {e}")
-            continue
-
-        # Save combined data for this sheet
-        combined_df['Sheet'] = sheet
-        combined_data.append(combined_df)
-
-        # Finalize figure
-        ax.set_xlabel('Time (min)')
-        ax.set_ylabel('Adsorption Amount (qt)')
-        ax.legend()
-        ax.set_title(f'Kinetic Fits for {sheet}')
-
-        # Save figure to memory
-        fig_io = BytesIO()
-        plt.savefig(fig_io, format='png')
-        plt.close(fig)
-        figure_paths.append(fig_io)
+            # Keep only the rows where both time and qt are finite numbers
+            t_raw = data['time(min)'].to_numpy()
+            q_raw = data['qt(mg/g)'].to_numpy()
+            try:
+                t_all = t_raw.astype(np.float64)
+                q_all = q_raw.astype(np.float64)
+            except ValueError:
+                st.error(f"Non-numeric data in sheet '{sheet}'. Skipping...")
+                continue
+            valid = np.isfinite(t_all) & np.isfinite(q_all)
+            t_data = t_all[valid]
+            q_data = q_all[valid]
+
+            q_var = q_data.var()  # Shared denominator of both R^2 values
+
+            ax.cla()
+            ax.plot(t_data, q_data, 'bo', label="Data")
+
+            # Prepare combined data frame (original values, as read from the sheet)
+            combined_df = pd.DataFrame({"time(min)": t_raw[valid], "qt(mg/g)": q_raw[valid]})
+
+            try:
+                # Fit pseudo-first-order
+                (q_e_1st, k1), _ = curve_fit(pseudo_first_order, t_data, q_data, p0=[np.max(q_data), 0.1],
+                                             jac=pseudo_first_order_jac, maxfev=CURVE_FIT_MAXFEV)
+                first_order_fit = pseudo_first_order(t_data, q_e_1st, k1)
+                ax.plot(t_data, first_order_fit, 'r-', label=f"1st Order: q_e={q_e_1st:.2f}")
+                r_squared_1st = 1 - (q_data - first_order_fit).var() / q_var
+                results_list.append({'Sheet': sheet, 'Model': 'Pseudo First Order', 
+                                     'q_e': q_e_1st, 'k': k1,
+                                     'R^2': r_squared_1st})
+                combined_df["Pseudo 1st Order"] = first_order_fit
+
+                # Fit pseudo-second-order
+                (q_e_2nd, k2), _ = curve_fit(pseudo_second_order, t_data, q_data, p0=[np.max(q_data), 0.001],
+                                             jac=pseudo_second_order_jac, maxfev=CURVE_FIT_MAXFEV)
+                second_order_fit = pseudo_second_order(t_data, q_e_2nd, k2)
+                ax.plot(t_data, second_order_fit, 'g--', label=f"2nd Order: q_e={q_e_2nd:.2f}")
+                r_squared_2nd = 1 - (q_data - second_order_fit).var() / q_var
+                results_list.append({'Sheet': sheet, 'Model': 'Pseudo Second Order', 
+                                     'q_e': q_e_2nd, 'k': k2,
+                                     'R^2': r_squared_2nd})
+                combined_df["Pseudo 2nd Order"] = second_order_fit
+
+            except Exception as e:
+                st.error(f"Error fitting model for sheet '{sheet}': {e}")
+                continue
+
+            # Save combined data for this sheet
+            combined_df['Sheet'] = sheet
+            combined_data.append(combined_df)
+
+            # Finalize figure
+            ax.set_xlabel('Time (min)')
+            ax.set_ylabel('Adsorption Amount (qt)')
+            ax.legend()
+            ax.set_title(f'Kinetic Fits for {sheet}')
+
+            # Save figure to memory
+            fig_io = BytesIO()
+            canvas.print_png(fig_io)
+            figure_paths.append(fig_io)
 
     # Return results as DataFrame and in-memory figures
     summary_df = pd.DataFrame(results_list)
@@ -0,0 +1,45 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from io import BytesIO
+import pandas as pd
+
+# Prefer the Rust-backed calamine reader; fall back to openpyxl if it isn't installed
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = 'calamine'
+except ImportError:
+    EXCEL_ENGINE = 'openpyxl'
+
+def open_workbook(file_path):
+    """Context manager for the workbook; an already-open pd.ExcelFile is used as is and left open."""
+    if isinstance(file_path, pd.ExcelFile):
+        return nullcontext(file_path)
+    return pd.ExcelFile(file_path, engine=EXCEL_ENGINE)
+
+def save_png(canvas, fig_path, **print_kwargs):
+    """Encode canvas as PNG once, write it to fig_path and return the bytes for display."""
+    fig_io = BytesIO()
+    canvas.print_png(fig_io, **print_kwargs)
+    fig_bytes = fig_io.getvalue()
+    with open(fig_path, 'wb') as f:
+        f.write(fig_bytes)
+    return fig_bytes
+
+def available_cpus():
+    """Number of CPUs this process may run on (respects affinity masks / container limits)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # Not available on Windows / macOS
+        return os.cpu_count() or 1
+
+def map_sheets(func, jobs):
+    """Run func(*job) for every job, in separate processes when more than one worker is useful.
+
+    Sheets are independent, so they can be processed in parallel; results keep the job order.
+    """
+    max_workers = min(len(jobs), available_cpus())
+    if max_workers > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(func, *zip(*jobs)))
+    return [func(*job) for job in jobs]